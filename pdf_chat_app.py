@@ -9,12 +9,52 @@ Usage:
 
 import os
 import re
-import json
+import csv
+import gzip
 import time
+import uuid
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from itertools import islice
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from flask import Flask, request, jsonify, Response, make_response, stream_with_context
+from typing import NamedTuple
+from flask import Flask, request, Response, make_response, stream_with_context
+from flask_compress import Compress
+from werkzeug.serving import WSGIRequestHandler
 import requests
-from io import BytesIO
+from requests.adapters import HTTPAdapter
+from io import BytesIO, StringIO
+
+# orjson is the fast path; ujson covers platforms without a prebuilt orjson wheel
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+
+    def _dumps_pretty(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+
+    def _preencoded(obj):
+        """Encode obj now; the result is spliced verbatim into later dumps() calls"""
+        return orjson.Fragment(orjson.dumps(obj))
+except ImportError:
+    import ujson
+    _loads = ujson.loads
+
+    def _dumps(obj) -> bytes:
+        return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode()
+
+    def _dumps_pretty(obj) -> bytes:
+        return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False, indent=2).encode()
+
+    def _preencoded(obj):
+        # ujson has no raw-fragment type, so the object is re-encoded on each use
+        return obj
 
 # ── Configuration ──────────────────────────────────────────────────────────────
 # OpenRouter settings
@@ -28,30 +68,96 @@ _FALLBACK_MODELS = [
     {"id": "qwen/qwen-2-7b-instruct:free",           "label": "Qwen 2 7B (free)"},
 ]
 FREE_MODELS = _FALLBACK_MODELS
+MODELS_TTL = 600
+FALLBACK_DELAY = 0.2
+MAX_RETRY_WAIT = 3
+RESPONSE_CACHE_SIZE = 256
+RESPONSE_CACHE_TTL = 3600
 MODEL = os.environ.get("OPENROUTER_MODEL", "meta-llama/llama-3.2-3b-instruct:free")
 
 OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
 MAX_FILE_BYTES = 10 * 1024 * 1024
 ALLOWED_EXT = {".pdf", ".txt", ".csv", ".json", ".md"}
+INDEX_MAX_AGE = 300
+PDF_CACHE_SIZE = 64
+PDF_PARALLEL_MIN_PAGES = 8
+PDF_BATCH_PAGES = 8
+PDF_MAX_WORDS = 10000
+PDF_STORAGE_SIZE = 100
+PDF_STORAGE_MAX_CHARS = 256 * 1024 * 1024
+TEXT_MAX_BYTES = 256 * 1024
+CSV_MAX_ROWS = 200
+PARSE_WORKERS = 4
 
 app = Flask(__name__)
 app.config["MAX_CONTENT_LENGTH"] = 20 * 1024 * 1024
+# SSE is left uncompressed: Flask-Compress buffers streamed bodies, which would hold back tokens
+app.config["COMPRESS_MIMETYPES"] = ["text/html", "text/css", "application/javascript", "application/json"]
+app.config["COMPRESS_MIN_SIZE"] = 500
+app.config["COMPRESS_STREAMS"] = False
+Compress(app)
 
-pdf_storage = {}
+# Uploaded documents by id, evicted least-recently-used (see store_document)
+pdf_storage = OrderedDict()
+_pdf_storage_chars = 0
+_pdf_storage_lock = threading.Lock()
 
 # ── OpenRouter Helpers ─────────────────────────────────────────────────────────
-def get_headers():
-    return {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": "http://localhost:5000",
-        "X-Title": "PDF Chat Assistant",
-    }
+_HEADERS = {
+    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+    "Content-Type": "application/json",
+    "HTTP-Referer": "http://localhost:5000",
+    "X-Title": "PDF Chat Assistant",
+}
+
+# Shared session so the TLS connection to openrouter.ai is reused across turns;
+# it owns the default headers, so requests don't rebuild or merge them per call
+SESSION = requests.Session()
+SESSION.headers.update(_HEADERS)
+# One connection retry covers a pooled keep-alive socket the server has since closed
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=64, max_retries=1))
+
+
+def stream_completion(resp):
+    """Yield content deltas from an OpenRouter SSE response as they arrive"""
+    # With chunked transfer, read each chunk as it arrives; fixed 512-byte reads
+    # would hold short deltas back until enough later tokens filled the buffer
+    chunk_size = None if resp.raw.chunked else 512
+    try:
+        for line in resp.iter_lines(chunk_size=chunk_size, decode_unicode=False):
+            # Skip keep-alive comments (": OPENROUTER PROCESSING") and blank lines
+            if not line.startswith(b"data: "):
+                continue
+            body = line[6:]
+            if body == b"[DONE]":
+                break
+            chunk = _loads(body)
+            if "error" in chunk:
+                raise RuntimeError(chunk["error"].get("message", str(chunk["error"])))
+            choices = chunk.get("choices") or [{}]
+            delta = choices[0].get("delta", {}).get("content")
+            if delta:
+                yield delta
+    finally:
+        resp.close()
+
+
+# Rate-limited model id -> time.time() before which it is skipped
+MODEL_COOLDOWNS = {}
+
+
+def parse_retry_after(resp, default):
+    """Seconds from a Retry-After header, or default if absent or not numeric"""
+    try:
+        return max(float(resp.headers["Retry-After"]), 0)
+    except (KeyError, ValueError):
+        return default
 
 
 def call_openrouter(payload, max_retries=3):
-    """POST to OpenRouter with retry logic"""
+    """POST to OpenRouter with retry logic, returning a generator of content deltas"""
     base_model = payload.get("model", MODEL)
+    payload["stream"] = True
     candidates = [base_model]
     
     # Add fallback models
@@ -61,19 +167,14 @@ def call_openrouter(payload, max_retries=3):
     
     tried = set()
     for candidate in candidates:
-        if candidate in tried:
+        if candidate in tried or MODEL_COOLDOWNS.get(candidate, 0) > time.time():
             continue
         tried.add(candidate)
         payload["model"] = candidate
         
         for attempt in range(max_retries):
             try:
-                resp = requests.post(
-                    OPENROUTER_URL,
-                    headers=get_headers(),
-                    json=payload,
-                    timeout=120
-                )
+                resp = SESSION.post(OPENROUTER_URL, data=_dumps(payload), stream=True, timeout=(5, 180))
             except requests.exceptions.Timeout:
                 if attempt < max_retries - 1:
                     time.sleep(2 ** attempt)
@@ -82,48 +183,84 @@ def call_openrouter(payload, max_retries=3):
             except Exception as e:
                 return None, candidate, str(e)
             
-            if resp.status_code == 429:
-                retry_after = int(resp.headers.get("Retry-After", 2 ** (attempt + 1)))
-                retry_after = min(retry_after, 10)
-                if attempt < max_retries - 1:
-                    time.sleep(retry_after)
-                    continue
-                else:
-                    break
+            # Rate-limited or overloaded: move on to the next free model after a
+            # short gate unless the limit clears within MAX_RETRY_WAIT
+            if resp.status_code == 429 or resp.status_code >= 500:
+                resp.close()
+                if resp.status_code == 429:
+                    retry_after = parse_retry_after(resp, 2 ** (attempt + 1))
+                    # Longer limits put the model on cooldown for later requests too
+                    if retry_after <= MAX_RETRY_WAIT and attempt < max_retries - 1:
+                        time.sleep(retry_after)
+                        continue
+                    MODEL_COOLDOWNS[candidate] = time.time() + retry_after
+                time.sleep(FALLBACK_DELAY)
+                break
             
             if not resp.ok:
                 try:
-                    err_body = resp.json()
+                    err_body = _loads(resp.content)
                     err_msg = err_body.get("error", {}).get("message", "") or str(err_body)
                 except Exception:
                     err_msg = resp.text or f"HTTP {resp.status_code}"
+                resp.close()
                 if resp.status_code == 404:
                     break
                 return None, candidate, f"{resp.status_code}: {err_msg}"
             
-            data = resp.json()
-            if "error" in data:
-                return None, candidate, data["error"].get("message", str(data["error"]))
-            
-            return data, candidate, None
+            return stream_completion(resp), candidate, None
     
-    return None, base_model, "All models rate-limited. Please wait and try again."
+    return None, base_model, "All models rate-limited or unavailable. Please wait and try again."
+
+
+# Completed replies keyed by a hash of the request, as (expires_at, text); evicted
+# least-recently-used or after RESPONSE_CACHE_TTL
+RESPONSE_CACHE = OrderedDict()
+_response_cache_lock = threading.Lock()
+
+
+def response_cache_key(payload) -> str:
+    """Hash the parts of a chat payload that determine the reply"""
+    key = _dumps([payload["model"], payload["temperature"], payload["max_tokens"], payload["messages"]])
+    return hashlib.sha1(key).hexdigest()
+
+
+def get_cached_response(key):
+    """Return a previously completed reply, or None"""
+    with _response_cache_lock:
+        entry = RESPONSE_CACHE.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            del RESPONSE_CACHE[key]
+            return None
+        RESPONSE_CACHE.move_to_end(key)
+        return entry[1]
+
+
+def store_cached_response(key, text):
+    """Remember a completed reply for identical future requests"""
+    with _response_cache_lock:
+        RESPONSE_CACHE[key] = (time.time() + RESPONSE_CACHE_TTL, text)
+        while len(RESPONSE_CACHE) > RESPONSE_CACHE_SIZE:
+            RESPONSE_CACHE.popitem(last=False)
+
+
+_models_expires = 0.0
+_models_refresh_lock = threading.Lock()
 
 
 def fetch_free_models():
     """Fetch live free models from OpenRouter"""
-    global FREE_MODELS
+    global FREE_MODELS, _models_expires
+    _models_expires = time.time() + MODELS_TTL
     try:
-        resp = requests.get(
-            "https://openrouter.ai/api/v1/models",
-            headers={"Authorization": f"Bearer {OPENROUTER_API_KEY}"},
-            timeout=10
-        )
+        resp = SESSION.get("https://openrouter.ai/api/v1/models", timeout=10)
         if not resp.ok:
             print(f"[models] Using fallback list (API {resp.status_code})")
             return
         
-        data = resp.json().get("data", [])
+        data = _loads(resp.content).get("data", [])
         free = []
         for m in data:
             pricing = m.get("pricing", {})
@@ -144,30 +281,204 @@ def fetch_free_models():
         print(f"[models] Fetch failed: {e}")
 
 
+def refresh_models_async():
+    """Refresh FREE_MODELS in a background thread once MODELS_TTL has expired"""
+    if time.time() < _models_expires or not _models_refresh_lock.acquire(blocking=False):
+        return
+    
+    def run():
+        try:
+            fetch_free_models()
+        finally:
+            _models_refresh_lock.release()
+    
+    threading.Thread(target=run, daemon=True).start()
+
+
 # ── PDF Processing ─────────────────────────────────────────────────────────────
-def parse_pdf(raw_bytes: bytes) -> str:
-    """Extract text from PDF"""
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+# PyMuPDF is not thread-safe, so in-process calls from request/parse threads take turns
+_mupdf_lock = threading.Lock()
+
+
+def get_pdf_pool():
+    """Lazily start the process pool used for large PDFs (about 1.5 s the first time)"""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # Never fork: the pool starts from a request thread while other threads are running
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _pdf_pool = ProcessPoolExecutor(max_workers=os.cpu_count(),
+                                            mp_context=multiprocessing.get_context(method))
+        return _pdf_pool
+
+
+def discard_pdf_pool(pool):
+    """Drop a broken pool (a worker crashed) so the next caller starts a fresh one"""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is pool:
+            _pdf_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _warm_worker():
+    """Import PyMuPDF in a fresh worker so the first real task doesn't pay for it"""
+    import pymupdf
+
+
+def warm_pdf_pool():
+    """Start the PDF workers at launch instead of inside the first large-PDF request"""
+    workers = os.cpu_count() or 1
+    if workers < 2:
+        return
+    pool = get_pdf_pool()
+    # One task per worker: the executor only spawns processes as work arrives
+    for _ in range(workers):
+        pool.submit(_warm_worker)
+
+
+def _extract_page_range(args):
+    """Extract text for pages [start, stop) in a worker process"""
+    import pymupdf
+    path, start, stop = args
+    # Each worker opens its own document; handles can't be shared across processes
+    doc = pymupdf.open(path, filetype="pdf")
+    try:
+        return [doc[i].get_text("text") for i in range(start, stop)]
+    finally:
+        doc.close()
+
+
+def iter_pdf_pages(raw_bytes: bytes):
+    """Yield the text of each PDF page, preferring PyMuPDF over PyPDF2"""
     try:
+        import pymupdf
+    except ImportError:
         from PyPDF2 import PdfReader
-        reader = PdfReader(BytesIO(raw_bytes))
+        for page in PdfReader(BytesIO(raw_bytes)).pages:
+            yield page.extract_text() or ""
+        return
+    
+    workers = os.cpu_count() or 1
+    with _mupdf_lock:
+        doc = pymupdf.open(stream=raw_bytes, filetype="pdf")
+        try:
+            page_count = doc.page_count
+            # Small documents aren't worth the cost of shipping bytes to workers
+            if page_count < PDF_PARALLEL_MIN_PAGES or workers < 2:
+                for page in doc:
+                    yield page.get_text("text")
+                return
+        finally:
+            doc.close()
+    
+    # Small batches submitted in page order, at most one per worker ahead of the reader.
+    # When parse_pdf stops at the word budget, closing this generator cancels the rest,
+    # so at most `workers` batches past the budget are extracted
+    batch_starts = iter(range(0, page_count, PDF_BATCH_PAGES))
+    pool = get_pdf_pool()
+    pending = deque()
+    # Workers read the PDF from disk; pickling the bytes into every task cost more than extraction
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        tmp.write(raw_bytes)
+    
+    def submit_next():
+        start = next(batch_starts, None)
+        if start is not None:
+            stop = min(start + PDF_BATCH_PAGES, page_count)
+            pending.append(pool.submit(_extract_page_range, (tmp.name, start, stop)))
+    
+    try:
+        for _ in range(workers):
+            submit_next()
+        while pending:
+            texts = pending.popleft().result()
+            submit_next()
+            yield from texts
+    except BrokenProcessPool:
+        # A worker died (crash or OOM kill), possibly on this very PDF; retrying it
+        # in-process could take the server down, so the upload fails instead
+        discard_pdf_pool(pool)
+        raise
+    finally:
+        for future in pending:
+            future.cancel()
+        try:
+            os.unlink(tmp.name)
+        except OSError:
+            pass
+
+
+_WORD_RE = re.compile(r"\S+")
+
+
+def parse_pdf(raw_bytes: bytes) -> str:
+    """Extract text from PDF, stopping once PDF_MAX_WORDS words are collected; raises on failure"""
+    pages_iter = iter_pdf_pages(raw_bytes)
+    try:
         pages = []
-        for i, page in enumerate(reader.pages):
-            text = page.extract_text() or ""
-            if text.strip():
-                pages.append(f"--- Page {i+1} ---\n{text.strip()}")
+        word_count = 0
+        truncated = False
+        for i, text in enumerate(pages_iter):
+            text = text.strip()
+            if not text:
+                continue
+            # Only scan as far as the word budget, plus one to detect overflow
+            remaining = PDF_MAX_WORDS - word_count
+            words = list(islice(_WORD_RE.finditer(text), remaining + 1))
+            if len(words) > remaining:
+                text = text[:words[remaining - 1].end()] if remaining else ""
+                truncated = True
+            word_count += len(words)
+            if text:
+                pages.append(f"--- Page {i+1} ---\n{text}")
+            if truncated:
+                # Closing pages_iter below stops extraction of the remaining pages
+                break
         
         if not pages:
             return "[PDF contains no extractable text]"
         
         full = "\n\n".join(pages)
-        words = full.split()
-        if len(words) > 10000:
-            full = " ".join(words[:10000]) + "\n\n[PDF TRUNCATED - showing first 10000 words]"
+        if truncated:
+            full += f"\n\n[PDF TRUNCATED - showing first {PDF_MAX_WORDS} words]"
         return full
+    finally:
+        pages_iter.close()
+
+
+# Parsed PDF text keyed by MD5 of the raw bytes, evicted least-recently-used
+PDF_CACHE = OrderedDict()
+_pdf_cache_lock = threading.Lock()
+
+
+def parse_pdf_cached(raw_bytes: bytes) -> str:
+    """Extract text from PDF, reusing the result for previously seen files"""
+    digest = hashlib.md5(raw_bytes).hexdigest()
+    with _pdf_cache_lock:
+        if digest in PDF_CACHE:
+            PDF_CACHE.move_to_end(digest)
+            return PDF_CACHE[digest]
+    
+    try:
+        text = parse_pdf(raw_bytes)
     except ImportError:
-        return "[PyPDF2 not installed. Run: pip install PyPDF2]"
+        return "[No PDF library installed. Run: pip install PyMuPDF]"
     except Exception as e:
+        # Not cached: the failure may be transient, and a retry should re-extract
         return f"[Could not extract PDF: {str(e)}]"
+    with _pdf_cache_lock:
+        PDF_CACHE[digest] = text
+        while len(PDF_CACHE) > PDF_CACHE_SIZE:
+            PDF_CACHE.popitem(last=False)
+    return text
+
+
+# Parses a multi-file request's uploads concurrently. In-process PyMuPDF holds the GIL and
+# is serialized by _mupdf_lock, so PDFs only overlap when large ones go to the process pool
+_parse_pool = ThreadPoolExecutor(max_workers=PARSE_WORKERS)
 
 
 def parse_uploaded_file(file) -> tuple:
@@ -178,28 +489,112 @@ def parse_uploaded_file(file) -> tuple:
     if ext not in ALLOWED_EXT:
         return filename, f"[Unsupported file type: {ext}]"
     
-    raw = file.read(MAX_FILE_BYTES)
-    
     if ext == ".pdf":
-        return filename, parse_pdf(raw)
+        # Read the spooled upload directly; a truncated PDF can't be parsed,
+        # so oversized files are rejected instead of sent to the extractor
+        raw = file.stream.read(MAX_FILE_BYTES + 1)
+        if len(raw) > MAX_FILE_BYTES:
+            return filename, f"[PDF exceeds the {MAX_FILE_BYTES // (1024 * 1024)} MB limit]"
+        return filename, parse_pdf_cached(raw)
+    
+    # Everything sent to the model is tokenized, so text files are capped before decoding
+    raw = file.read(TEXT_MAX_BYTES + 1)
+    truncated = len(raw) > TEXT_MAX_BYTES
+    raw = raw[:TEXT_MAX_BYTES]
+    
+    if ext == ".csv":
+        return filename, preview_csv(raw, truncated)
+    if ext == ".json" and not truncated:
+        try:
+            pretty = _dumps_pretty(_loads(raw))
+            truncated = len(pretty) > TEXT_MAX_BYTES
+            raw = pretty[:TEXT_MAX_BYTES]
+        except ValueError:
+            pass
     
     try:
         text = raw.decode("utf-8", errors="replace")
     except Exception:
         return filename, "[Could not decode file]"
     
-    if len(raw) == MAX_FILE_BYTES:
+    if truncated:
         text += "\n\n[FILE TRUNCATED]"
     
     return filename, text
 
 
-# ── Conversational Detection ───────────────────────────────────────────────────
-CONVERSATIONAL_PATTERNS = re.compile(
-    r"^\s*(hi+|hello+|hey+|thanks?|thank\s*you|ok+ay?|cool|nice|bye|"
-    r"what\s*can\s*you\s*do|help|who\s*are\s*you)\s*[!?.]*\s*$",
-    re.IGNORECASE
-)
+def preview_csv(raw: bytes, truncated: bool) -> str:
+    """Header plus the first CSV_MAX_ROWS rows of a CSV upload"""
+    decoded = raw.decode("utf-8", errors="replace")
+    try:
+        rows = list(islice(csv.reader(StringIO(decoded)), CSV_MAX_ROWS + 2))
+    except csv.Error:
+        # Oversized field or unclosed quote: fall back to the plain capped text
+        return decoded + "\n\n[FILE TRUNCATED]" if truncated else decoded
+    if len(rows) > CSV_MAX_ROWS + 1:
+        rows = rows[:CSV_MAX_ROWS + 1]
+        truncated = True
+    
+    out = StringIO()
+    csv.writer(out, lineterminator="\n").writerows(rows)
+    text = out.getvalue()
+    if truncated:
+        text += f"\n[CSV TRUNCATED - showing first {CSV_MAX_ROWS} rows]"
+    return text
+
+
+class PdfEntry(NamedTuple):
+    """Parsed upload kept in pdf_storage"""
+    filename: str
+    text: str
+    uploaded_at: float
+    size: int
+
+
+def store_document(filename: str, text: str) -> str:
+    """Keep parsed upload text in memory and return its id"""
+    global _pdf_storage_chars
+    # Random rather than sequential: ids round-trip through the client's history,
+    # so a counter would let one user read another's documents by guessing
+    file_id = uuid.uuid4().hex
+    entry = PdfEntry(filename, text, time.time(), len(text))
+    with _pdf_storage_lock:
+        pdf_storage[file_id] = entry
+        _pdf_storage_chars += entry.size
+        # Bounded by both entry count and total text held; the new entry itself is always kept
+        while len(pdf_storage) > 1 and (
+            len(pdf_storage) > PDF_STORAGE_SIZE or _pdf_storage_chars > PDF_STORAGE_MAX_CHARS
+        ):
+            _, evicted = pdf_storage.popitem(last=False)
+            _pdf_storage_chars -= evicted.size
+    return file_id
+
+
+def get_document(file_id: str):
+    """Look up a stored upload, or None if it was never stored or was evicted"""
+    with _pdf_storage_lock:
+        entry = pdf_storage.get(file_id)
+        if entry is not None:
+            pdf_storage.move_to_end(file_id)
+        return entry
+
+
+# ── Chat History ───────────────────────────────────────────────────────────────
+def split_history(history):
+    """Validate client chat history and collect the document ids it references"""
+    turns, refs = [], []
+    if not isinstance(history, list):
+        return turns, refs
+    for item in history:
+        if not isinstance(item, dict) or item.get("role") not in ("user", "assistant"):
+            continue
+        turn = {"role": item["role"], "content": str(item.get("content", ""))}
+        item_refs = [r for r in item.get("pdf_refs") or [] if isinstance(r, str)]
+        if item_refs:
+            turn["pdf_refs"] = item_refs
+            refs.extend(item_refs)
+        turns.append(turn)
+    return turns, refs
 
 
 # ── System Prompt ──────────────────────────────────────────────────────────────
@@ -228,6 +623,10 @@ When analyzing PDFs:
 """
 
 
+# The system message never changes, so it's encoded once for turns without documents
+_SYSTEM_MESSAGE_JSON = _preencoded({"role": "system", "content": SYSTEM_PROMPT})
+
+
 # ── HTML Template ──────────────────────────────────────────────────────────────
 HTML_TEMPLATE = r"""<!DOCTYPE html>
 <html lang="en">
@@ -377,6 +776,8 @@ main { display: flex; flex-direction: column; overflow: hidden; }
 .input-hint kbd { font-family: var(--mono); font-size: 10px; background: var(--panel); border: 1px solid var(--border2); border-radius: 4px; padding: 2px 6px; color: var(--text-dim); }
 .clear-btn { background: none; border: 1px solid var(--border); border-radius: 8px; color: var(--text-dim); font-size: 11px; padding: 4px 10px; cursor: pointer; font-family: var(--mono); transition: all .2s; margin-left: auto; }
 .clear-btn:hover { border-color: var(--error); color: var(--error); }
+.regen-btn + .clear-btn { margin-left: 8px; }
+.regen-btn:hover { border-color: var(--primary); color: var(--primary-bright); }
 
 /* Error Toast */
 #error-toast { position: fixed; bottom: 90px; right: 24px; background: rgba(239,68,68,.15); border: 1px solid var(--error); border-radius: 10px; padding: 12px 16px; font-size: 13px; color: var(--error); display: none; z-index: 100; animation: fadeIn .3s ease; box-shadow: var(--shadow); }
@@ -441,6 +842,7 @@ main { display: flex; flex-direction: column; overflow: hidden; }
       </div>
       <div class="input-hint">
         <span><kbd>Enter</kbd> send • <kbd>Shift+Enter</kbd> newline</span>
+        <button class="clear-btn regen-btn" onclick="regenerate()">↻ Regenerate</button>
         <button class="clear-btn" onclick="clearChat()">✕ Clear chat</button>
       </div>
     </div>
@@ -506,14 +908,34 @@ async function sendMessage() {
   fd.append('message', text);
   fd.append('history', JSON.stringify(chatHistory));
   filesCopy.forEach((f, i) => fd.append('file_'+i, f));
+  await streamReply(fd, text, typingEl);
+}
 
+// Re-asks the last question with the server's reply cache bypassed
+async function regenerate() {
+  if (isStreaming || chatHistory.length < 2) return;
+  const [userTurn, lastReply] = chatHistory.splice(-2);
+  msgs.querySelector('.msg.assistant:last-of-type')?.remove();
+  const typingEl = appendTyping();
+  setStreaming(true);
+
+  const fd = new FormData();
+  fd.append('message', userTurn.content);
+  fd.append('history', JSON.stringify(chatHistory));
+  if (userTurn.pdf_refs) fd.append('pdf_refs', JSON.stringify(userTurn.pdf_refs));
+  fd.append('no_cache', '1');
+  if (!await streamReply(fd, userTurn.content, typingEl)) chatHistory.push(userTurn, lastReply);
+}
+
+// Streams one /chat response into a new assistant bubble; resolves true once the turn is recorded
+async function streamReply(fd, text, typingEl) {
+  let finished = false;
   try {
     const res = await fetch('/chat', { method: 'POST', body: fd });
     if (!res.ok) throw new Error('Server error ' + res.status);
     const reader = res.body.getReader();
     const decoder = new TextDecoder();
-    let buf = '';
-    typingEl.remove();
+    let buf = '', render = null, reply = '';
 
     while (true) {
       const { done, value } = await reader.read();
@@ -524,19 +946,24 @@ async function sendMessage() {
         if (!line.startsWith('data: ')) continue;
         let evt; try { evt = JSON.parse(line.slice(6)); } catch { continue; }
         if (evt.type === 'text') {
-          appendAssistantMsg(evt.content);
+          if (!render) { typingEl.remove(); render = createStreamRenderer(appendAssistantMsg('').querySelector('.msg-bubble')); }
+          render(evt.content); reply += evt.content;
+          scrollBottom();
         } else if (evt.type === 'done') {
-          chatHistory = evt.history || [];
+          chatHistory.push(evt.user || {role: 'user', content: text}, {role: 'assistant', content: reply.trim()});
+          finished = true;
         } else if (evt.type === 'error') {
           showError(evt.content);
         }
       }
     }
+    typingEl.remove();
   } catch(err) {
     typingEl?.remove();
     showError('Connection error: ' + err.message);
   }
   setStreaming(false); scrollBottom();
+  return finished;
 }
 
 const msgs = document.getElementById('messages');
@@ -548,7 +975,6 @@ function appendUserMsg(text, files) {
   const chips = files.length ? '<div class="attached-files">'+files.map(f=>'<span class="attach-chip">📎 '+esc(f.name)+'</span>').join('')+'</div>' : '';
   div.innerHTML = '<div class="msg-avatar">👤</div><div class="msg-body">'+chips+(text?'<div class="msg-bubble">'+esc(text)+'</div>':'')+'</div>';
   msgs.appendChild(div); scrollBottom();
-  if (text) chatHistory.push({ role: 'user', content: text });
 }
 
 function appendTyping() {
@@ -565,18 +991,93 @@ function appendAssistantMsg(text) {
   msgs.appendChild(div); scrollBottom(); return div;
 }
 
+const MD_ITEM = /^([*-]|\d+\.) (.*)$/, MD_INLINE = /[`*]/g;
+const MD_EDGE_NL = /^\n+|\n+$/g;
+
+// Single pass over the lines of a message: fenced code, ### headings,
+// bullet/numbered lists and paragraphs, with inline spans in renderInline.
 function renderMarkdown(text) {
-  let h = esc(text);
-  h = h.replace(/```(\w*)\n([\s\S]*?)```/g, (_, l, code) => '<pre><code>'+code.trim()+'</code></pre>');
-  h = h.replace(/`([^`]+)`/g, '<code>$1</code>');
-  h = h.replace(/^### (.+)$/gm, '<h3>$1</h3>');
-  h = h.replace(/\*\*([^*]+)\*\*/g, '<strong>$1</strong>');
-  h = h.replace(/\*([^*]+)\*/g, '<em>$1</em>');
-  h = h.replace(/^[*-] (.+)$/gm, '<li>$1</li>');
-  h = h.replace(/(<li>.*<\/li>(\n|$))+/g, m => '<ul>'+m+'</ul>');
-  h = h.replace(/^\d+\. (.+)$/gm, '<li>$1</li>');
-  h = h.split(/\n\n+/).map(p => p.trim().startsWith('<') ? p : '<p>'+p.replace(/\n/g,'<br>')+'</p>').join('');
-  return h;
+  const out = [], para = [];
+  let list = null, fence = null, m;
+  const flush = () => {
+    if (para.length) { out.push('<p>'+para.map(renderInline).join('<br>')+'</p>'); para.length = 0; }
+    if (list) { out.push('</'+list+'>'); list = null; }
+  };
+  const closeFence = () => { out.push('<pre><code>'+esc(fence.join('\n').trim())+'</code></pre>'); fence = null; };
+  for (const line of text.split('\n')) {
+    if (fence) { if (line.startsWith('```')) closeFence(); else fence.push(line); }
+    else if (line.startsWith('```')) { flush(); fence = []; }
+    else if (!line.trim()) flush();
+    else if (line.startsWith('### ')) { flush(); out.push('<h3>'+renderInline(line.slice(4))+'</h3>'); }
+    else if ((m = MD_ITEM.exec(line))) {
+      const tag = m[1].endsWith('.') ? 'ol' : 'ul';
+      // Blank or indented lines between items split the list; start= keeps the numbering going
+      if (list !== tag) {
+        const n = parseInt(m[1]);
+        flush(); out.push(tag === 'ol' && n !== 1 ? '<ol start="'+n+'">' : '<'+tag+'>'); list = tag;
+      }
+      out.push('<li>'+renderInline(m[2])+'</li>');
+    } else { if (list) flush(); para.push(line); }
+  }
+  if (fence) closeFence();
+  flush();
+  return out.join('');
+}
+
+// `code`, **bold** and *em* in one left-to-right scan; unmatched markers stay literal.
+function renderInline(s) {
+  let out = '', i = 0;
+  while (i < s.length) {
+    MD_INLINE.lastIndex = i;
+    const hit = MD_INLINE.exec(s), k = hit ? hit.index : s.length;
+    out += esc(s.slice(i, k));
+    if (!hit) break;
+    const mark = s.startsWith('**', k) ? '**' : s[k];
+    const end = s.indexOf(mark, k + mark.length), inner = end > k + mark.length ? s.slice(k + mark.length, end) : '';
+    if (inner && (mark === '`' || !inner.includes('*'))) {
+      out += mark === '`' ? '<code>'+esc(inner)+'</code>' : mark === '**' ? '<strong>'+renderInline(inner)+'</strong>' : '<em>'+renderInline(inner)+'</em>';
+      i = end + mark.length;
+    } else { out += esc(s[k]); i = k + 1; }
+  }
+  return out;
+}
+
+// Streams markdown into a bubble, consuming each line once as it completes.
+// Blocks before a blank line or an opening fence are rendered once and appended;
+// fenced code lines are appended to an open <pre> as text. Only the unfinished
+// paragraph or list block is re-rendered per chunk, so a very long paragraph
+// still costs O(block) per token.
+function createStreamRenderer(bubble) {
+  let text = '', stableLen = 0, lineEnd = 0, code = null, tailNodes = [];
+  const put = md => {
+    const t = document.createElement('template'); t.innerHTML = md ? renderMarkdown(md) : '';
+    const nodes = [...t.content.childNodes]; bubble.append(t.content); return nodes;
+  };
+  return delta => {
+    text += delta;
+    tailNodes.forEach(n => n.remove());
+    let nl;
+    while ((nl = text.indexOf('\n', lineEnd)) !== -1) {
+      const line = text.slice(lineEnd, nl);
+      if (code) {
+        if (line.startsWith('```')) { code.textContent = code.textContent.trim(); code = null; stableLen = nl + 1; }
+        else code.append(line + '\n');
+      } else if (line.startsWith('```')) {
+        put(text.slice(stableLen, lineEnd).replace(MD_EDGE_NL, ''));
+        const pre = document.createElement('pre'); code = document.createElement('code');
+        pre.append(code); bubble.append(pre); stableLen = nl + 1;
+      } else if (!line.trim()) {
+        put(text.slice(stableLen, lineEnd).replace(MD_EDGE_NL, '')); stableLen = nl + 1;
+      }
+      lineEnd = nl + 1;
+    }
+    if (code) {
+      const rest = text.slice(lineEnd);
+      // A closing fence without its newline yet (e.g. at the end of the reply)
+      if (rest.startsWith('```')) { code.textContent = code.textContent.trim(); tailNodes = []; }
+      else { tailNodes = [document.createTextNode(rest)]; code.append(tailNodes[0]); }
+    } else tailNodes = put(text.slice(stableLen).replace(MD_EDGE_NL, ''));
+  };
 }
 
 function esc(s) { return String(s).replace(/&/g,'&amp;').replace(/</g,'&lt;').replace(/>/g,'&gt;').replace(/"/g,'&quot;'); }
@@ -623,7 +1124,11 @@ async function changeModel(modelId) {
   } catch(e) { showError('Model switch failed: ' + e.message); }
 }
 
+let lastHealthCheck = 0;
 async function checkHealth() {
+  // Debounced: tab focus can fire repeatedly, and the key status rarely changes
+  if (Date.now() - lastHealthCheck < 15000) return;
+  lastHealthCheck = Date.now();
   try {
     const d = await (await fetch('/health')).json();
     document.getElementById('dot-api').className = 'status-dot ' + (d.api_ok ? 'ok' : 'fail');
@@ -632,123 +1137,259 @@ async function checkHealth() {
 
 loadModels();
 checkHealth();
-setInterval(checkHealth, 15000);
+// Re-check when the tab becomes visible instead of polling from every open tab forever
+document.addEventListener('visibilitychange', () => {
+  if (document.visibilityState === 'visible') checkHealth();
+});
 </script>
 </body>
 </html>"""
 
 
 # ── Routes ─────────────────────────────────────────────────────────────────────
+def ojsonify(obj, status=200):
+    """jsonify() equivalent serialized with orjson (or ujson)"""
+    return Response(_dumps(obj), status=status, mimetype="application/json")
+
+
+def sse_event(evt) -> bytes:
+    """Encode one server-sent event frame, already as bytes for Werkzeug"""
+    return b"data: " + _dumps(evt) + b"\n\n"
+
+
+_TEXT_PREFIX = b'data: {"type":"text","content":'
+_TEXT_SUFFIX = b"}\n\n"
+
+
+def sse_text(content: str) -> bytes:
+    """sse_event({"type": "text", ...}) without building a dict per streamed token"""
+    return _TEXT_PREFIX + _dumps(content) + _TEXT_SUFFIX
+
+
+# The client appends the turn itself, so a plain text turn needs no payload
+_DONE_FRAME = b'data: {"type":"done"}\n\n'
+
+
+# Encoded, compressed and hashed once at import rather than on every page load
+_HTML_BYTES = HTML_TEMPLATE.encode("utf-8")
+_HTML_GZ = gzip.compress(_HTML_BYTES, 6)
+_HTML_ETAG = hashlib.sha1(_HTML_BYTES).hexdigest()
+
+
 @app.route("/")
 def index():
-    return HTML_TEMPLATE
+    # Debug runs skip caching so template edits show up on reload
+    if app.debug:
+        return HTML_TEMPLATE
+    
+    use_gzip = "gzip" in request.accept_encodings
+    # Variants are tagged "<etag>:gzip" like Flask-Compress does, so match on the base tag
+    if _HTML_ETAG in {tag.split(":")[0] for tag in request.if_none_match.as_set()}:
+        resp = Response(status=304)
+    elif use_gzip:
+        resp = Response(_HTML_GZ, mimetype="text/html")
+        resp.headers["Content-Encoding"] = "gzip"
+    else:
+        resp = Response(_HTML_BYTES, mimetype="text/html")
+    resp.set_etag(f"{_HTML_ETAG}:gzip" if use_gzip else _HTML_ETAG)
+    resp.vary.add("Accept-Encoding")
+    resp.cache_control.public = True
+    resp.cache_control.max_age = INDEX_MAX_AGE
+    return resp
 
 
 @app.route("/chat", methods=["POST"])
 def chat():
     history_raw = request.form.get("history", "[]")
     user_message = request.form.get("message", "").strip()
+    no_cache = request.form.get("no_cache") == "1"
     
-    try:
-        history = json.loads(history_raw)
-    except Exception:
+    # A fresh conversation sends "[]"; skip the parser for it
+    if history_raw in ("[]", ""):
         history = []
+    else:
+        try:
+            history = _loads(history_raw)
+        except Exception:
+            history = []
+    history, doc_refs = split_history(history)
     
     file_contexts = []
-    for key in request.files:
-        f = request.files[key]
-        if f and f.filename:
-            fname, ftext = parse_uploaded_file(f)
-            file_contexts.append((fname, ftext))
-            # Store in memory
-            file_id = f"{fname}_{int(time.time())}"
-            pdf_storage[file_id] = ftext
-    
-    content_parts = []
-    if file_contexts:
-        for fname, ftext in file_contexts:
-            content_parts.append(f"[DOCUMENT: {fname}]\n{ftext}\n")
-    if user_message:
-        content_parts.append(user_message)
+    # Regenerating a turn resends the ids of the documents it originally attached
+    try:
+        new_refs = [r for r in _loads(request.form.get("pdf_refs") or "[]") if isinstance(r, str)]
+    except (ValueError, TypeError):
+        new_refs = []
+    # items(multi=True) also yields repeated field names; iterating keys or values() keeps only the first
+    uploads = [f for _, f in request.files.items(multi=True) if f and f.filename]
+    # The shared pool only helps when this request has several files to overlap; a single
+    # upload parses on the request thread instead of queueing behind other users' PDFs
+    if len(uploads) > 1:
+        futures = [_parse_pool.submit(parse_uploaded_file, f) for f in uploads]
+        parsed = [future.result() for future in futures]
+    else:
+        parsed = [parse_uploaded_file(f) for f in uploads]
+    for fname, ftext in parsed:
+        file_contexts.append((fname, ftext))
+        # Store in memory; later turns reference it by id instead of resending the text
+        new_refs.append(store_document(fname, ftext))
     
-    full_user_content = "\n\n".join(content_parts)
+    if not user_message and not file_contexts:
+        return ojsonify({"error": "No message or files provided"}, 400)
     
-    if not full_user_content:
-        return jsonify({"error": "No message or files provided"}), 400
+    # Every referenced document is expanded once, into this request's system prompt.
+    # Pieces go into one list and a single join, so multi-MB texts are copied only once
+    content_parts = [SYSTEM_PROMPT]
+    append = content_parts.append
+    missing_docs = 0
+    for file_id in dict.fromkeys(doc_refs + new_refs):
+        entry = get_document(file_id)
+        if entry is None:
+            # Evicted from pdf_storage or lost on restart
+            missing_docs += 1
+            continue
+        if len(content_parts) == 1:
+            append("\nUPLOADED DOCUMENTS:\n\n")
+        append("[DOCUMENT: ")
+        append(entry.filename)
+        append("]\n")
+        append(entry.text)
+        append("\n\n")
+    if missing_docs:
+        # Without this the model answers as if the document never existed
+        append(f"\nNOTE: {missing_docs} document(s) uploaded earlier in this conversation are no longer "
+               "available. If the question depends on them, ask the user to upload them again.\n")
+    system_content = "".join(content_parts)
     
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-    messages.extend(history)
-    messages.append({"role": "user", "content": full_user_content})
+    # History keeps only this marker; the text itself lives in pdf_storage behind pdf_refs
+    user_content = user_message
+    if file_contexts:
+        marker = "[Attached: " + ", ".join(fname for fname, _ in file_contexts) + "]"
+        user_content = f"{user_message}\n{marker}" if user_message else marker
+    user_turn = {"role": "user", "content": user_content}
+    if new_refs:
+        user_turn["pdf_refs"] = new_refs
     
-    is_conversational = (
-        len(file_contexts) == 0 and
-        bool(CONVERSATIONAL_PATTERNS.match(user_message))
-    )
+    if len(content_parts) > 1:
+        messages = [{"role": "system", "content": system_content}]
+    else:
+        messages = [_SYSTEM_MESSAGE_JSON]
+    messages.extend({"role": m["role"], "content": m["content"]} for m in history)
+    messages.append({"role": "user", "content": user_content})
     
     def generate():
-        nonlocal messages
+        if missing_docs:
+            yield sse_event({"type": "error", "content": f"{missing_docs} earlier document(s) expired "
+                                                         "from the server; please re-upload them"})
+        requested_model = MODEL
         payload = {
-            "model": MODEL,
-            "messages": messages,
+            "model": requested_model,
+            # Encoded once; the cache key and every fallback attempt splice in these bytes
+            "messages": _preencoded(messages),
             "temperature": 0.3,
             "max_tokens": 2000,
         }
         
-        data, used_model, err = call_openrouter(payload)
-        if err:
-            evt = json.dumps({"type": "error", "content": err})
-            yield f"data: {evt}\n\n"
-            return
-        
-        choice = data["choices"][0]
-        msg = choice["message"]
-        messages.append(msg)
-        
-        final_text = msg.get("content", "").strip()
-        if final_text:
-            yield f"data: {json.dumps({'type': 'text', 'content': final_text})}\n\n"
+        cache_key = response_cache_key(payload)
+        cached = None if no_cache else get_cached_response(cache_key)
+        if cached is not None:
+            reply_text = cached
+            yield sse_text(cached)
+        else:
+            deltas, used_model, err = call_openrouter(payload)
+            if err:
+                yield sse_event({"type": "error", "content": err})
+                return
+            
+            parts = []
+            try:
+                for delta in deltas:
+                    parts.append(delta)
+                    yield sse_text(delta)
+            except Exception as e:
+                yield sse_event({"type": "error", "content": str(e)})
+                return
+            
+            reply_text = "".join(parts).strip()
+            # The key names the selected model (call_openrouter rewrites payload["model"]
+            # while falling back); a fallback's reply must not answer for it later
+            if reply_text and used_model == requested_model:
+                store_cached_response(cache_key, reply_text)
         
-        yield f"data: {json.dumps({'type': 'done', 'history': messages[1:]})}\n\n"
+        # Only a turn the client can't rebuild (document refs, placeholder text) is sent back
+        if user_turn == {"role": "user", "content": user_message}:
+            yield _DONE_FRAME
+        else:
+            yield sse_event({"type": "done", "user": user_turn})
     
     return Response(
         stream_with_context(generate()),
-        content_type="text/event-stream",
-        headers={"X-Accel-Buffering": "no"}
+        mimetype="text/event-stream",
+        headers={"X-Accel-Buffering": "no", "Cache-Control": "no-cache"}
     )
 
 
+# (FREE_MODELS list, MODEL, encoded /models body, gzipped body); rebuilt when either changes
+_models_body = (None, None, b"", b"")
+
+
 @app.route("/models")
 def get_models():
-    current = MODEL
-    ids = [m["id"] for m in FREE_MODELS]
-    if current not in ids and FREE_MODELS:
-        current = FREE_MODELS[0]["id"]
-    return jsonify({"models": FREE_MODELS, "current": current})
+    global _models_body
+    # Serve the cached list immediately; a stale one is refreshed for the next caller
+    refresh_models_async()
+    models, model, body, body_gz = _models_body
+    if models is not FREE_MODELS or model != MODEL:
+        models, model = FREE_MODELS, MODEL
+        current = model
+        if current not in {m["id"] for m in models} and models:
+            current = models[0]["id"]
+        body = _dumps({"models": models, "current": current})
+        body_gz = gzip.compress(body, 6)
+        _models_body = (models, model, body, body_gz)
+    
+    # Compressed once per catalog change instead of by Flask-Compress on every poll
+    if "gzip" in request.accept_encodings:
+        resp = Response(body_gz, mimetype="application/json")
+        resp.headers["Content-Encoding"] = "gzip"
+    else:
+        resp = Response(body, mimetype="application/json")
+    resp.vary.add("Accept-Encoding")
+    return resp
 
 
 @app.route("/set-model", methods=["POST"])
 def set_model():
     global MODEL
-    data = request.get_json()
-    new_model = data.get("model", "").strip()
+    try:
+        data = _loads(request.get_data())
+    except ValueError:
+        return ojsonify({"error": "Invalid JSON body"}, 400)
+    new_model = data.get("model", "").strip() if isinstance(data, dict) else ""
     if not new_model:
-        return jsonify({"error": "No model specified"}), 400
+        return ojsonify({"error": "No model specified"}, 400)
     MODEL = new_model
-    return jsonify({"ok": True, "model": MODEL})
+    return ojsonify({"ok": True, "model": MODEL})
 
 
 @app.route("/health")
 def health():
     api_ok = bool(OPENROUTER_API_KEY and OPENROUTER_API_KEY != "XXXXX_API_KEY_XXXXX")
-    return jsonify({
+    return ojsonify({
         "api_ok": api_ok,
         "model": MODEL,
         "status": "ok" if api_ok else "degraded"
     })
 
 
+class NoDelayRequestHandler(WSGIRequestHandler):
+    """Dev-server handler with Nagle disabled so small SSE frames are sent immediately"""
+    disable_nagle_algorithm = True
+
+
 if __name__ == "__main__":
-    fetch_free_models()
+    refresh_models_async()
+    warm_pdf_pool()
     print("=" * 60)
     print("  PDF Chat Assistant")
     print("=" * 60)
@@ -757,4 +1398,9 @@ if __name__ == "__main__":
     print(f"  API Key: {key_hint}")
     print(f"  URL: http://localhost:5000")
     print("=" * 60)
-    app.run(debug=True, port=5000, threaded=True)
+    if os.environ.get("FLASK_DEBUG") == "1":
+        app.run(debug=True, port=5000, threaded=True, request_handler=NoDelayRequestHandler)
+    else:
+        # Waitress writes each streamed chunk straight to the socket (TCP_NODELAY by default)
+        from waitress import serve
+        serve(app, host="127.0.0.1", port=5000, threads=16, channel_timeout=600)